@@ -1,4 +1,5 @@
 import argparse
+import asyncio
 import logging
 import os
 import sys
@@ -6,9 +7,8 @@ from dotenv import load_dotenv
 from datetime import datetime
 from src.parser import parse_regulatory_documents, parse_sop_document
 from src.extractor import extract_clauses
-from src.vector_db import initialize_chroma_collection, add_clauses_to_vectordb, retrieve_relevant_clauses_for_sop
-from src.generate_report import generate_report, save_markdown
-from langchain_anthropic import ChatAnthropic
+
+PHASES = ("parse", "extract", "embed", "report", "all")
 
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
@@ -31,11 +31,20 @@ def setup_logging():
     
     return logging.getLogger(__name__)
 
-def main():
+async def amain():
     parser = argparse.ArgumentParser(description="Regulatory Compliance Document Processor")
     parser.add_argument("sop_path", help="Path to the SOP file")
     parser.add_argument("regulatory_path", help="Path to the folder containing regulatory documents")
+    parser.add_argument("--phase", choices=PHASES, default="all", help="Pipeline phase to run; 'all' runs ingestion (if needed) and the report")
     parser.add_argument("--add_new_clauses", action="store_true", help="Enable adding new clauses from regulatory pdf files")
+    parser.add_argument("--force", action="store_true", help="Re-parse and re-extract regulations even if outputs are up to date")
+    parser.add_argument("--fast_ingest", action="store_true", help="Relax ChromaDB's SQLite durability settings for faster clause upserts (a crash mid-ingest can corrupt the store)")
+    parser.add_argument("--batch_size", type=int, default=None, help="Max number of clauses per ChromaDB upsert call (default: 500 for a local store, 250 over HTTP)")
+    parser.add_argument("--embedding_backend", choices=["default", "infinity", "sentence-transformers", "onnx-int8"], default="default", help="Embedding backend for clauses and SOP chunks")
+    parser.add_argument("--infinity_url", default="http://localhost:7997", help="URL of the Infinity embedding server")
+    parser.add_argument("--embedding_device", default=None, help="Device for the sentence-transformers backend, e.g. 'cuda' or 'cpu' (default: GPU if available)")
+    parser.add_argument("--query_cache_size", type=int, default=2000, help="Max number of cached clause retrieval results")
+    parser.add_argument("--query_cache_ttl", type=float, default=600, help="Seconds before a cached clause retrieval result expires")
     
     args = parser.parse_args()
     logger = setup_logging()
@@ -49,59 +58,102 @@ def main():
     os.makedirs(clauses_dir, exist_ok=True)
     
     logger.info("Starting Regulatory Compliance Document Processor")
+    logger.info(f"Phase: {args.phase}")
     logger.info(f"SOP Path: {args.sop_path}")
-    if args.add_new_clauses:
-        logger.info(f"Regulatory Documents Path: {args.regulatory_path}")
+    logger.info(f"Regulatory Documents Path: {args.regulatory_path}")
     logger.info(f"Output Directory: {output_dir}")
 
-    # init LangChain Client
-    logger.info("Initializing LangChain Anthropic client")
-    anthropic_client = ChatAnthropic(
-        api_key=os.getenv("ANTHROPIC_API_KEY"),
-        model="claude-3-7-sonnet-20250219",
-        temperature=0.1,
-        max_tokens=8192
-    )
+    phase = args.phase
+    run_report = phase in ("report", "all")
+
+    # Init VectorDB to stored extracted clauses (chromadb is slow to import,
+    # so only pull it in for the phases that need it)
+    collection = None
+    if phase in ("embed", "report", "all"):
+        from src.vector_db import initialize_chroma_collection, configure_query_cache, get_embedding_function
+        embedding_function = get_embedding_function(args.embedding_backend, args.infinity_url, args.embedding_device)
+        collection = initialize_chroma_collection(embedding_function=embedding_function, fast_ingest=args.fast_ingest)
+        configure_query_cache(max_size=args.query_cache_size, ttl_seconds=args.query_cache_ttl)
 
-    # Init VectorDB to stored extracted clauses
-    collection = initialize_chroma_collection()
+    ingest = phase == "all" and (args.add_new_clauses or collection.count() == 0)
+    if ingest and not args.add_new_clauses:
+        logger.info("Clause collection is empty, ingesting regulatory documents")
 
     try:
         logger.info("Document processing phase starting...")
 
         # parse SOP (DOCS)
-        parse_sop_document(args.sop_path, parsed_data_dir)
         parsed_sop_dir = os.path.join(parsed_data_dir, "parsed_sop.txt")
+        if phase in ("parse", "report", "all"):
+            parse_sop_document(args.sop_path, parsed_data_dir)
 
-        if args.add_new_clauses:
+        if phase == "parse" or ingest:
             # parse regulation files (PDF)
-            parse_regulatory_documents(args.regulatory_path, parsed_data_dir)
+            parse_regulatory_documents(args.regulatory_path, parsed_data_dir, force=args.force)
 
+        if phase == "extract" or ingest:
             # extract clauses from parsed regulation files
             parsed_reg_file_path = os.path.join(parsed_data_dir, "parsed_regulation_files")
-            extract_clauses(parsed_reg_file_path, clauses_dir)
+            extract_clauses(parsed_reg_file_path, clauses_dir, force=args.force)
+
+        if phase == "embed" or ingest:
+            from src.vector_db import add_clauses_to_vectordb
 
             # add extracted clauses to vectordb
-            add_clauses_to_vectordb(collection, clauses_dir, chunk_size=100)
-
-        # Analyize SOP and Generate Report using Langchain + Anthropic API
-        retrived_clauses = retrieve_relevant_clauses_for_sop(
-            parsed_sop_dir,
-            collection,
-            chunk_size=150,
-            overlap=40,
-            top_n=3
-        )
-
-        # Generate the report using llm
-        report = generate_report(
-            parsed_sop_dir,
-            retrived_clauses,
-            anthropic_client
-        )
-
-        # Save the report as a markdown file
-        save_markdown(report.content)
+            add_clauses_to_vectordb(
+                collection,
+                clauses_dir,
+                chunk_size=args.batch_size,
+                embedding_function=embedding_function,
+                embedding_cache_path=os.path.join(parsed_data_dir, "embedding_cache", "clause_embeddings.sqlite3")
+            )
+
+        if run_report:
+            from src.vector_db import aretrieve_relevant_clauses_for_sop, load_or_compute_sop_embeddings
+            from src.generate_report import agenerate_report, read_sop_text, save_markdown
+            from langchain_anthropic import ChatAnthropic
+
+            # init LangChain Client
+            logger.info("Initializing LangChain Anthropic client")
+            anthropic_client = ChatAnthropic(
+                api_key=os.getenv("ANTHROPIC_API_KEY"),
+                model="claude-3-7-sonnet-20250219",
+                temperature=0.1,
+                max_tokens=8192
+            )
+
+            sop_chunk_size, sop_overlap = 150, 40
+            sop_embeddings = load_or_compute_sop_embeddings(
+                parsed_sop_dir,
+                embedding_function,
+                os.path.join(parsed_data_dir, "embedding_cache"),
+                chunk_size=sop_chunk_size,
+                overlap=sop_overlap
+            )
+
+            # Analyize SOP and Generate Report using Langchain + Anthropic API
+            # (read the SOP and retrieve its relevant clauses concurrently)
+            sop_text, retrived_clauses = await asyncio.gather(
+                asyncio.to_thread(read_sop_text, parsed_sop_dir),
+                aretrieve_relevant_clauses_for_sop(
+                    parsed_sop_dir,
+                    collection,
+                    chunk_size=sop_chunk_size,
+                    overlap=sop_overlap,
+                    top_n=3,
+                    precomputed_embeddings=sop_embeddings
+                )
+            )
+
+            # Generate the report using llm
+            report = await agenerate_report(
+                sop_text,
+                retrived_clauses,
+                anthropic_client
+            )
+
+            # Save the report as a markdown file
+            save_markdown(report.content)
 
         logger.info("Processing completed successfully")
         
@@ -111,5 +163,8 @@ def main():
     
     return 0
 
+def main():
+    return asyncio.run(amain())
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,27 +1,90 @@
 import re
-import json
+import orjson
 import os
+import sys
+import mmap
 import logging
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from src.utils import atomic_write, is_up_to_date
+
+try:
+    import re2
+except ImportError:
+    re2 = None
 
 logger = logging.getLogger(__name__)
 
+_PATTERNS = {
+    'section': re.compile(r'^\s*§\s*\d'),
+    'decimal': re.compile(r'^\s*\d+\.\d'),
+    'numeric': re.compile(r'^\s*\d+[\.\)](?!\d)'),
+    'roman':   re.compile(r'^\s*(?=[IVXLCDMivxlcdm]+[\.\)])[IVXLCDMivxlcdm]+[\.\)]'),
+    'letter':  re.compile(r'^\s*(?:\([A-Za-z]\)|[A-Za-z][\.\)])')
+}
+
+_HEADER_PATTERNS = {
+    'numeric': re.compile(r'^\s*(\d+[\.\)])'),
+    'decimal': re.compile(r'^\s*((?:\d+\.\d+(?:\.\d+)*|\d+\.))'),
+    'roman':   re.compile(r'^\s*([IVXLCDMivxlcdm]+[\.\)])'),
+    'letter':  re.compile(r'^\s*((?:\([A-Za-z]\)|[A-Za-z][\.\)]))'),
+    'section': re.compile(r'^\s*(§\s*\d+(?:\.\d+)*)')
+}
+
+# All of _PATTERNS fused into one alternation; m.lastgroup names the style.
+# Only 'roman' and 'letter' can both match a line (e.g. "I."), and the roman
+# branch is tried first, so count_matches re-checks 'letter' on roman hits.
+_COMBINED_PATTERN = re.compile(
+    r'^\s*(?:(?P<section>§\s*\d)'
+    r'|(?P<decimal>\d+\.\d)'
+    r'|(?P<numeric>\d+[\.\)](?!\d))'
+    r'|(?P<roman>(?=[IVXLCDMivxlcdm]+[\.\)])[IVXLCDMivxlcdm]+[\.\)])'
+    r'|(?P<letter>\([A-Za-z]\)|[A-Za-z][\.\)]))'
+)
+
+_SECTION_OR_DECIMAL_PATTERN = re.compile(r'^\s*(?:(?P<section>§\s*\d)|(?P<decimal>\d+\.\d))')
+
+# Versions of _HEADER_PATTERNS for scanning a whole '\n'-prefixed document at once.
+# Anchoring on a literal '\n' instead of a MULTILINE '^' lets the regex engine
+# jump between line starts, and [^\S\n] keeps a header from spanning lines.
+_DOCUMENT_HEADER_PATTERNS = {
+    style: re.compile('\n' + pattern.pattern[1:].replace(r'\s', r'[^\S\n]'))
+    for style, pattern in _HEADER_PATTERNS.items()
+}
+_HYPHEN_BREAK_PATTERN = re.compile(r'-\n')
+# Same idea for the section/decimal fast path of format detection
+_DOCUMENT_SECTION_PATTERN = re.compile('\n' + _PATTERNS['section'].pattern[1:].replace(r'\s', r'[^\S\n]'))
+_DOCUMENT_DECIMAL_PATTERN = re.compile('\n' + _PATTERNS['decimal'].pattern[1:].replace(r'\s', r'[^\S\n]'))
+
+# Sentence boundaries: punctuation followed by whitespace
+_SENTENCE_SPLIT_PATTERN = re.compile(r'(?<=[.!?])\s+')
+# Sequences of 6 or more non-English characters. RE2 (google-re2) runs this
+# as a DFA when installed; its \s only covers ASCII whitespace, so the
+# whitespace that Python's \s matches is spelled out to keep results identical.
+if re2 is not None:
+    _NON_ENGLISH_PATTERN = re2.compile(
+        "[^A-Za-z0-9\t-\r\x1c- \x85\xa0\u1680\u2000-\u200a\u2028\u2029\u202f\u205f\u3000]{6,}"
+    )
+else:
+    _NON_ENGLISH_PATTERN = re.compile(r'[^A-Za-z0-9\s]{6,}')
+
+_ROMAN_CHARS_DELETE_TABLE = str.maketrans('', '', 'IVXLCDMivxlcdm')
+
 def compile_patterns():
-    """Compile regex patterns for different clause formats."""
-    return {
-        'section': re.compile(r'^\s*§\s*\d'),
-        'decimal': re.compile(r'^\s*\d+\.\d'),
-        'numeric': re.compile(r'^\s*\d+[\.\)](?!\d)'),
-        'roman':   re.compile(r'^\s*(?=[IVXLCDMivxlcdm]+[\.\)])[IVXLCDMivxlcdm]+[\.\)]'),
-        'letter':  re.compile(r'^\s*(?:\([A-Za-z]\)|[A-Za-z][\.\)])')
-    }
+    """Return the compiled regex patterns for different clause formats."""
+    return _PATTERNS
 
 def count_matches(lines, patterns):
     """Count how many lines match each pattern and return a dict of counts."""
     counts = {name: 0 for name in patterns}
+    letter_pattern = patterns['letter']
     for line in lines:
-        for name, pattern in patterns.items():
-            if pattern.match(line):
-                counts[name] += 1
+        m = _COMBINED_PATTERN.match(line)
+        if m:
+            style = m.lastgroup
+            counts[style] += 1
+            if style == 'roman' and letter_pattern.match(line):
+                counts['letter'] += 1
     return counts
 
 def resolve_roman_letter_conflict(lines, patterns):
@@ -29,16 +92,17 @@ def resolve_roman_letter_conflict(lines, patterns):
     Distinguish between roman and letter format by examining tokens.
     Return either 'roman' or 'letter' based on multi-character tokens.
     """
-    roman_chars = set("IVXLCDMivxlcdm")
     has_multi_roman = has_multi_letter = False
     for line in lines:
         if patterns['roman'].match(line) or patterns['letter'].match(line):
             token = line.strip().split()[0]
             token = token.rstrip('.)').lstrip('(')
-            if len(token) > 1 and all(ch in roman_chars for ch in token):
-                has_multi_roman = True
-            elif len(token) > 1 and not all(ch in roman_chars for ch in token):
-                has_multi_letter = True
+            if len(token) > 1:
+                # Deleting the roman numeral characters leaves nothing iff the token is all roman
+                if token.translate(_ROMAN_CHARS_DELETE_TABLE):
+                    has_multi_letter = True
+                else:
+                    has_multi_roman = True
     if has_multi_roman and not has_multi_letter:
         return 'roman'
     if has_multi_letter and not has_multi_roman:
@@ -47,14 +111,22 @@ def resolve_roman_letter_conflict(lines, patterns):
 
 def detect_format(lines):
     """Detect the enumeration format of the clauses by pattern matching."""
+    # Fast path: a single section header settles the style, and a decimal one
+    # does unless a section header shows up further down.
+    has_decimal = False
+    for line in lines:
+        m = _SECTION_OR_DECIMAL_PATTERN.match(line)
+        if m:
+            if m.lastgroup == 'section':
+                return 'section'
+            has_decimal = True
+    if has_decimal:
+        return 'decimal'
+
     patterns = compile_patterns()
     counts = count_matches(lines, patterns)
 
     # Order of priority checks
-    if counts['section'] > 0:
-        return 'section'
-    if counts['decimal'] > 0:
-        return 'decimal'
     if counts['roman'] > 0 and counts['letter'] > 0:
         conflict_resolution = resolve_roman_letter_conflict(lines, patterns)
         if conflict_resolution:
@@ -69,54 +141,47 @@ def detect_format(lines):
         return 'numeric'
     return None
 
+def detect_document_format(document):
+    """
+    Detect the enumeration format of a '\n'-prefixed document of stripped,
+    non-blank lines. Section and decimal headers are searched for directly
+    in the document; only other formats fall back to a per-line detect_format.
+    """
+    if _DOCUMENT_SECTION_PATTERN.search(document):
+        return 'section'
+    if _DOCUMENT_DECIMAL_PATTERN.search(document):
+        return 'decimal'
+    return detect_format(document[1:].split('\n'))
+
 def get_header_pattern(style):
     """Return the compiled regex for the given style."""
-    if style == 'numeric':
-        return re.compile(r'^\s*(\d+[\.\)])')
-    elif style == 'decimal':
-        return re.compile(r'^\s*((?:\d+\.\d+(?:\.\d+)*|\d+\.))')
-    elif style == 'roman':
-        return re.compile(r'^\s*([IVXLCDMivxlcdm]+[\.\)])')
-    elif style == 'letter':
-        return re.compile(r'^\s*((?:\([A-Za-z]\)|[A-Za-z][\.\)]))')
-    elif style == 'section':
-        return re.compile(r'^\s*(§\s*\d+(?:\.\d+)*)')
-    return None
+    return _HEADER_PATTERNS.get(style)
 
-def build_clause(line, match):
-    """Initialize a new clause dict with ID and text from the match."""
-    clause_id = match.group(1)
-    content_start = match.end()
-    # Remainder of the line after header
-    clause_text = line[content_start:].lstrip()
-    return {'id': clause_id, 'text': clause_text}
-
-def process_line(line, current_clause):
-    """Append or merge a line's text to the current_clause."""
-    line_text = line.strip()
-    if current_clause['text'].endswith('-'):
-        # Merge hyphenated word
-        current_clause['text'] = current_clause['text'][:-1] + line_text
-    else:
-        # Insert space for normal line break
-        current_clause['text'] += ' ' + line_text
+def clean_clause_body(body):
+    """
+    Turn the text following a clause header (stripped, non-blank lines joined by
+    '\n') into the clause text: lines are joined by a space, except that a line
+    ending in '-' is merged with the next one (hyphenated word).
+    """
+    head, sep, tail = body.partition('\n')
+    return _HYPHEN_BREAK_PATTERN.sub('', head.lstrip() + sep + tail).replace('\n', ' ')
 
 def build_decimal_hierarchy(clauses):
-    """Build nested structure for decimal-style clauses."""
+    """
+    Build nested structure for decimal-style clauses.
+    Every node gets a (possibly empty) 'subclauses' list.
+    """
     clause_tree = []
     node_index = {}
     for clause in clauses:
         cid = clause['id']
-        ctext = clause['text']
-        node = {'id': cid, 'text': ctext}
-        norm_id = cid[:-1] if cid.endswith('.') else cid
+        node = {'id': cid, 'text': clause['text'], 'subclauses': []}
+        norm_id = sys.intern(cid[:-1] if cid.endswith('.') else cid)
         node_index[norm_id] = node
-        parent_id = None
-        if '.' in norm_id:
-            parent_id = norm_id.rsplit('.', 1)[0]
-        if parent_id and parent_id in node_index:
-            parent = node_index[parent_id]
-            parent.setdefault('subclauses', []).append(node)
+        dot = norm_id.rfind('.')
+        parent = node_index.get(norm_id[:dot]) if dot != -1 else None
+        if parent is not None:
+            parent['subclauses'].append(node)
         else:
             clause_tree.append(node)
     return clause_tree
@@ -126,38 +191,35 @@ def extract(text):
     Extract regulatory clauses from text and return a structured
     list or nested list of clauses, ready to be converted into JSON.
     """
-    lines = text.splitlines()
-    style = detect_format(lines)
+    # Strip every line and drop blank ones up front; header detection ignores
+    # surrounding whitespace and clause text is built from stripped lines.
+    # Only the joined document is kept, so no line list outlives this
+    # statement. The leading '\n' lets the first line match like the others.
+    text = '\n' + '\n'.join(filter(None, map(str.strip, text.splitlines())))
+    style = detect_document_format(text)
     if not style:
         logger.warning("No recognizable clause format detected in file.")
         return []
     # else:
     #     logger.info(f"Detected format: {style}")
 
-    header_pat = get_header_pattern(style)
+    # Each header starts a clause whose body runs up to the next header;
+    # content before the first header is treated as noise.
+    header_pat = _DOCUMENT_HEADER_PATTERNS[style]
+    matches = list(header_pat.finditer(text))
     clauses = []
-    current_clause = None
-
-    for line in lines:
-        if not line.strip():
-            continue
-        match = header_pat.match(line) if header_pat else None
-        if match:
-            if current_clause:
-                current_clause['text'] = current_clause['text'].rstrip()
-                clauses.append(current_clause)
-            current_clause = build_clause(line, match)
-        else:
-            if not current_clause:
-                # Content before any recognized header is treated as noise
-                continue
-            process_line(line, current_clause)
+    for i, match in enumerate(matches):
+        body_end = matches[i + 1].start() if i + 1 < len(matches) else len(text)
+        clauses.append({
+            'id': match.group(1),
+            'text': clean_clause_body(text[match.end():body_end])
+        })
 
+    last_clause = clauses.pop() if clauses else None
     clauses = filter_clauses(clauses)
 
-    if current_clause:
-        current_clause['text'] = current_clause['text'].rstrip()
-        clauses.append(current_clause)
+    if last_clause:
+        clauses.append(last_clause)
 
     if style == 'decimal':
         return build_decimal_hierarchy(clauses)
@@ -171,8 +233,14 @@ def split_large_entries(clauses, sentences_per_chunk=5):
     logger.info("Splitting large entries into smaller chunks.")
     new_clauses = []
     for clause in clauses:
+        text = clause["text"]
+        # Every sentence break follows a terminator, so a text with fewer than
+        # sentences_per_chunk of them can't have too many sentences
+        if text.count('.') + text.count('!') + text.count('?') < sentences_per_chunk:
+            new_clauses.append(clause)
+            continue
         # Split text into sentences using punctuation followed by whitespace.
-        sentences = re.split(r'(?<=[.!?])\s+', clause["text"].strip())
+        sentences = _SENTENCE_SPLIT_PATTERN.split(text.strip())
         if len(sentences) > sentences_per_chunk:
             parts = [ " ".join(sentences[i:i+sentences_per_chunk]).strip() 
                       for i in range(0, len(sentences), sentences_per_chunk) ]
@@ -194,38 +262,73 @@ def filter_clauses(clauses):
     or that contain a sequence of non-English characters (length > 5).
     """
     filtered = []
-    # Regex for sequences of 6 or more non-English characters
-    pattern_non_english = re.compile(r'[^A-Za-z0-9\s]{6,}')
     for clause in clauses:
         text = clause["text"].strip()
         if not text:
             continue
         if len(text) < 5:
             continue
-        if pattern_non_english.search(text):
+        if _NON_ENGLISH_PATTERN.search(text):
             continue
         filtered.append(clause)
     return filtered
 
-def extract_clauses(input_dir, output_dir):
+def _clauses_path(file_path, output_dir):
+    """Return the {base_name}_clauses.json path for a .txt input file."""
+    base_name = os.path.splitext(os.path.basename(file_path))[0]
+    return os.path.join(output_dir, f"{base_name}_clauses.json")
+
+def _process_one(file_path, output_dir):
+    """Extract clauses from one .txt file and write them to {base_name}_clauses.json."""
+    txt_file = os.path.basename(file_path)
+    # Decode straight out of a read-only mapping of the file, so no bytes copy
+    # of it is held in memory next to the decoded text (mmap rejects empty files)
+    with open(file_path, "rb") as f:
+        if os.fstat(f.fileno()).st_size:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                text = str(mm, "utf-8")
+        else:
+            text = ""
+
+    logger.info(f"Extracting file: {txt_file}.")
+    clauses = extract(text)
+    
+    if len(clauses) < 5:
+        logger.info(f"File '{txt_file}' has less than 5 clauses. Checking for large entries to split.")
+        clauses = split_large_entries(clauses)
+
+    output_path = _clauses_path(file_path, output_dir)
+    logger.info(f"Extracted file: {txt_file}.")
+
+    with atomic_write(output_path, "wb") as out_f:
+        out_f.write(orjson.dumps(clauses, option=orjson.OPT_INDENT_2))
+    return output_path
+
+def extract_clauses(input_dir, output_dir, max_workers=None, force=False):
+    """
+    Extract clauses from every .txt file in input_dir in parallel, one process per file.
+    Files whose clauses JSON is already newer than the .txt are skipped unless force is set.
+    """
     os.makedirs(output_dir, exist_ok=True)
-    txt_files = [f for f in os.listdir(input_dir) if f.lower().endswith(".txt")]
-
-    for txt_file in txt_files:
-        file_path = os.path.join(input_dir, txt_file)
-        with open(file_path, "r", encoding="utf-8") as f:
-            text = f.read()
-
-        logger.info(f"Extracting file: {txt_file}.")
-        clauses = extract(text)
-        
-        if len(clauses) < 5:
-            logger.info(f"File '{txt_file}' has less than 5 clauses. Checking for large entries to split.")
-            clauses = split_large_entries(clauses)
-
-        base_name = os.path.splitext(txt_file)[0]
-        output_path = os.path.join(output_dir, f"{base_name}_clauses.json")
-        logger.info(f"Extracted file: {txt_file}.")
-
-        with open(output_path, "w", encoding="utf-8") as out_f:
-            json.dump(clauses, out_f, indent=2)
\ No newline at end of file
+    with os.scandir(input_dir) as it:
+        file_paths = [e.path for e in it if e.is_file() and e.name.lower().endswith(".txt")]
+    if not file_paths:
+        logger.warning(f"No .txt files found in {input_dir}")
+        return
+
+    if not force:
+        stale_paths = [p for p in file_paths if not is_up_to_date(p, _clauses_path(p, output_dir))]
+        skipped = len(file_paths) - len(stale_paths)
+        if skipped:
+            logger.info(f"Skipping {skipped} file(s) whose clauses are up to date")
+        file_paths = stale_paths
+        if not file_paths:
+            return
+
+    if max_workers is None:
+        max_workers = min(os.cpu_count() or 1, len(file_paths))
+
+    # Hand each worker a few files per task so large corpora don't pay one IPC round-trip per file
+    chunksize = max(1, len(file_paths) // (4 * max_workers))
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(partial(_process_one, output_dir=output_dir), file_paths, chunksize=chunksize))
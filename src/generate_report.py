@@ -1,4 +1,6 @@
 import logging
+import os
+from functools import lru_cache
 
 logger = logging.getLogger(__name__)
 
@@ -12,20 +14,19 @@ def create_template_prompt(sop_text, retrieved_chunks):
         - "relevant_clauses": a list of clause dicts with keys "id", "text", "metadata", etc.
     :return: A formatted prompt string ready to send to the LLM.
     """
-    # Use a dict to deduplicate clauses by their 'id'
-    clause_map = {}
+    # Format each clause the first time its 'id' is seen, deduplicating in the same pass
+    seen_ids = set()
+    formatted = []
     for chunk in retrieved_chunks:
         for clause in chunk.get("relevant_clauses", []):
             # Here we assume each clause dict has an 'id'
             clause_id = clause.get("id")
-            if clause_id and clause_id not in clause_map:
-                clause_map[clause_id] = clause
-
-    # Format all unique clauses into a string
-    clauses_formatted = "\n".join(
-        f"- ID: {clause['id']}\n  Text: {clause['text']}\n  Source: {clause.get('metadata', {}).get('doc_id', 'N/A')}"
-        for clause in clause_map.values()
-    )
+            if clause_id and clause_id not in seen_ids:
+                seen_ids.add(clause_id)
+                formatted.append(
+                    f"- ID: {clause_id}\n  Text: {clause['text']}\n  Source: {clause.get('metadata', {}).get('doc_id', 'N/A')}"
+                )
+    clauses_formatted = "\n".join(formatted)
 
     prompt = f"""
 You are a regulatory compliance expert.
@@ -44,6 +45,19 @@ Please provide a detailed compliance analysis. Structure your output in Markdown
 """
     return prompt
 
+@lru_cache(maxsize=8)
+def _read_sop_text_cached(sop_path, mtime_ns, size):
+    with open(sop_path, "r", encoding="utf-8") as f:
+        return f.read()
+
+def read_sop_text(sop_path):
+    """
+    Read the parsed SOP text file. Reads are cached per path and only
+    repeated once the file's modification time or size changes.
+    """
+    stat = os.stat(sop_path)
+    return _read_sop_text_cached(sop_path, stat.st_mtime_ns, stat.st_size)
+
 def generate_report(sop_path, retrieved_chunks, anthropic_client):
     """
     Generates a report by analyzing the SOP (Standard Operating Procedure) text and retrieved chunks using the provided anthropic client.
@@ -58,12 +72,29 @@ def generate_report(sop_path, retrieved_chunks, anthropic_client):
     """
     # Call the API. If the client returns an object, adjust to access its content.
     logger.info("Start generating analysis of the SOP...")
-    with open(sop_path, "r", encoding="utf-8") as f:
-        sop_text = f.read()
+    sop_text = read_sop_text(sop_path)
     prompt = create_template_prompt(sop_text, retrieved_chunks)
     response = anthropic_client.invoke(prompt)
     return response
 
+async def agenerate_report(sop_text, retrieved_chunks, anthropic_client):
+    """
+    Async counterpart of generate_report that takes the already-read SOP text,
+    so the caller can read it concurrently with clause retrieval.
+
+    Args:
+        sop_text (str): The full SOP text.
+        retrieved_chunks (list): A list of text chunks retrieved for analysis.
+        anthropic_client (object): An instance of the anthropic client used to invoke the analysis API.
+
+    Returns:
+        object: The response from the anthropic client after processing the prompt.
+    """
+    logger.info("Start generating analysis of the SOP...")
+    prompt = create_template_prompt(sop_text, retrieved_chunks)
+    response = await anthropic_client.ainvoke(prompt)
+    return response
+
 def save_markdown(content, file_path="output/annotated_sop_report.md"):
     """
     Saves the provided Markdown content to a file.
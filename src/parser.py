@@ -1,59 +1,183 @@
-from pdfminer.high_level import extract_text
+from pdfminer.high_level import extract_text, extract_text_to_fp
+from pdfminer.layout import LAParams
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
 import os
 import logging
 from pathlib import Path
-import docx
+import zipfile
+from lxml import etree
 import json
 import re
+from src.utils import atomic_write, is_up_to_date
+
+try:
+    import pymupdf
+except ImportError:
+    pymupdf = None
+
+try:
+    import pypdfium2 as pdfium
+except ImportError:
+    pdfium = None
 
 logger = logging.getLogger(__name__)
 
-def parse_pdf(pdf_path):
+def iter_pdf_pages(pdf_path):
+    """
+    Yield the text of a PDF one page at a time, using PyMuPDF if installed,
+    else PDFium (pypdfium2), else pdfminer (which yields the whole text at once).
+    """
+    if pymupdf is not None:
+        with pymupdf.open(pdf_path) as doc:
+            for page in doc:
+                yield page.get_text("text", flags=pymupdf.TEXT_PRESERVE_WHITESPACE)
+    elif pdfium is not None:
+        pdf = pdfium.PdfDocument(pdf_path)
+        try:
+            for page in pdf:
+                textpage = page.get_textpage()
+                # PDFium ends lines with '\r\n'
+                yield textpage.get_text_bounded().replace("\r\n", "\n")
+                textpage.close()
+                page.close()
+        finally:
+            pdf.close()
+    else:
+        yield extract_text(pdf_path)
+
+
+def parse_pdf(pdf_path, output_file):
+    """
+    Stream the text of pdf_path into output_file page by page and return output_file.
+    output_file is only replaced once the whole PDF has been parsed.
+    """
     logger.info(f"Parsing PDF: {pdf_path}")
     try:
-        text = extract_text(pdf_path)
-        if not text.strip():
+        if pymupdf is not None or pdfium is not None:
+            has_text = False
+            with atomic_write(output_file, 'w', encoding='utf-8') as f:
+                for i, page_text in enumerate(iter_pdf_pages(pdf_path)):
+                    if i:
+                        f.write("\n")
+                    f.write(page_text)
+                    has_text = has_text or bool(page_text.strip())
+        else:
+            # pdfminer writes its text straight into the output file
+            with open(pdf_path, 'rb') as pdf_fp, atomic_write(output_file, 'wb') as out_fp:
+                extract_text_to_fp(pdf_fp, out_fp, laparams=LAParams(), output_type='text', codec='utf-8')
+            has_text = os.path.getsize(output_file) > 0
+        if not has_text:
             logger.warning(f"No text extracted from {pdf_path}")
-        return text
+        return output_file
             
     except Exception as e:
         logger.error(f"Error parsing PDF {pdf_path}: {str(e)}")
         raise
 
 
-def parse_regulatory_documents(regulatory_dir, output_dir):
+def parse_regulatory_documents(regulatory_dir, output_dir, max_workers=None, max_concurrent_results=None, force=False):
+    """
+    Parse every PDF in regulatory_dir in a process pool, writing the text of each
+    one to parsed_regulation_files/{doc_name}.txt under output_dir.
+    PDFs whose .txt is already newer than the PDF are skipped unless force is set.
+    Returns the list of .txt paths.
+
+    At most max_concurrent_results parse jobs are queued at once.
+    """
     logger.info(f"Processing regulatory documents from {regulatory_dir}")
     
     parsed_reg_dir = os.path.join(output_dir, "parsed_regulation_files")
     os.makedirs(parsed_reg_dir, exist_ok=True)
     
-    documents = {}
-    pdf_files = [f for f in os.listdir(regulatory_dir) if f.lower().endswith('.pdf')]
+    output_paths = []
+    with os.scandir(regulatory_dir) as it:
+        pdf_files = [e for e in it if e.is_file() and e.name.lower().endswith('.pdf')]
     
     if not pdf_files:
         logger.warning(f"No PDF files found in {regulatory_dir}")
-        return documents
+        return output_paths
     
     logger.info(f"Found {len(pdf_files)} regulatory PDF files")
+
+    jobs = []
+    for pdf_entry in pdf_files:
+        output_file = os.path.join(parsed_reg_dir, f"{Path(pdf_entry.name).stem}.txt")
+        if not force and is_up_to_date(pdf_entry.path, output_file):
+            logger.info(f"Skipping {pdf_entry.name}, parsed text is up to date")
+            output_paths.append(output_file)
+        else:
+            jobs.append((pdf_entry, output_file))
+
+    if not jobs:
+        return output_paths
+
+    if max_workers is None:
+        max_workers = min(os.cpu_count() or 1, len(jobs))
+    if max_concurrent_results is None:
+        max_concurrent_results = 2 * max_workers
+
+    pending_jobs = iter(jobs)
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+
+        def submit_next():
+            job = next(pending_jobs, None)
+            if job is not None:
+                pdf_entry, output_file = job
+                futures[executor.submit(parse_pdf, pdf_entry.path, output_file)] = pdf_entry.name
+
+        for _ in range(max_concurrent_results):
+            submit_next()
+
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                pdf_file = futures.pop(future)
+                submit_next()
+
+                try:
+                    output_paths.append(future.result())
+                    logger.info(f"Successfully parsed and saved {Path(pdf_file).stem}")
+
+                except Exception as e:
+                    logger.error(f"Failed to process {pdf_file}: {str(e)}")
     
-    for pdf_file in pdf_files:
-        pdf_path = os.path.join(regulatory_dir, pdf_file)
-        
-        try:
-            text = parse_pdf(pdf_path)
-            doc_name = Path(pdf_file).stem
-            output_file = os.path.join(parsed_reg_dir, f"{doc_name}.txt")
-            
-            with open(output_file, 'w', encoding='utf-8') as f:
-                f.write(text)
-            
-            documents[doc_name] = text
-            logger.info(f"Successfully parsed and saved {doc_name}")
-            
-        except Exception as e:
-            logger.error(f"Failed to process {pdf_file}: {str(e)}")
-    
-    return documents
+    return output_paths
+
+
+_W_NS = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+_W_RUN_TEXT = {
+    _W_NS + "tab": "\t",
+    _W_NS + "ptab": "\t",
+    _W_NS + "cr": "\n",
+    _W_NS + "noBreakHyphen": "-",
+}
+
+
+def _run_text(run):
+    """Return the text of a <w:r> element, matching python-docx's Run.text."""
+    parts = []
+    for el in run:
+        if el.tag == _W_NS + "t":
+            parts.append(el.text or "")
+        elif el.tag == _W_NS + "br":
+            # Line breaks become newlines; page and column breaks are dropped
+            if el.get(_W_NS + "type", "textWrapping") == "textWrapping":
+                parts.append("\n")
+        else:
+            parts.append(_W_RUN_TEXT.get(el.tag, ""))
+    return "".join(parts)
+
+
+def _paragraph_text(p):
+    """Return the text of a <w:p> element, matching python-docx's Paragraph.text."""
+    parts = []
+    for child in p:
+        if child.tag == _W_NS + "r":
+            parts.append(_run_text(child))
+        elif child.tag == _W_NS + "hyperlink":
+            parts.extend(_run_text(run) for run in child.iterchildren(_W_NS + "r"))
+    return "".join(parts)
 
 
 def parse_sop_document(sop_path, output_dir):
@@ -63,10 +187,12 @@ def parse_sop_document(sop_path, output_dir):
         if not sop_path.lower().endswith('.docx'):
             raise ValueError(f"Expected DOCX file format for SOP, got: {sop_path}")
         
-        doc = docx.Document(sop_path)
-        full_text = []
-        for para in doc.paragraphs:
-            full_text.append(para.text)
+        # Read the body paragraphs straight from word/document.xml instead of
+        # building python-docx's full document object model
+        with zipfile.ZipFile(sop_path) as docx_zip:
+            root = etree.fromstring(docx_zip.read("word/document.xml"))
+        body = root.find(_W_NS + "body")
+        full_text = [_paragraph_text(p) for p in body.iterchildren(_W_NS + "p")]
         
         content = '\n'.join(full_text)
         output_file = os.path.join(output_dir, f"parsed_sop.txt")
@@ -80,4 +206,4 @@ def parse_sop_document(sop_path, output_dir):
         
     except Exception as e:
         logger.error(f"Error parsing SOP document {sop_path}: {str(e)}")
-        raise
\ No newline at end of file
+        raise
@@ -0,0 +1,31 @@
+import os
+from contextlib import contextmanager
+
+
+def is_up_to_date(source_path, output_path):
+    """Return True if output_path exists, is non-empty and is at least as new as source_path."""
+    try:
+        output_stat = os.stat(output_path)
+    except FileNotFoundError:
+        return False
+    return output_stat.st_size > 0 and output_stat.st_mtime >= os.path.getmtime(source_path)
+
+
+@contextmanager
+def atomic_write(output_path, mode="w", **open_kwargs):
+    """
+    Open a temporary file next to output_path for writing and move it into place
+    only if the block succeeds, so a failure never leaves a partial output_path
+    behind (which is_up_to_date would otherwise take as up to date).
+    """
+    tmp_path = f"{output_path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, mode, **open_kwargs) as f:
+            yield f
+        os.replace(tmp_path, output_path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
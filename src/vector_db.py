@@ -1,149 +1,833 @@
+import asyncio
+import inspect
 import os
-import json
+import sys
+import mmap
+import queue
+import atexit
+import sqlite3
+import orjson
 import logging
+import hashlib
+import importlib.util
+import time
+import numpy as np
+import requests
 import chromadb
 import chromadb.utils.embedding_functions as embedding_functions
-from collections import defaultdict
+from chromadb.api.types import Documents, EmbeddingFunction, Embeddings
+from chromadb.utils.embedding_functions.onnx_mini_lm_l6_v2 import ONNXMiniLM_L6_V2
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import cached_property, lru_cache
+from threading import BoundedSemaphore, Event, RLock, Thread
 import math
-from typing import List, Dict
+from typing import List, Dict, Callable, Hashable, Any, Optional
 from tqdm import tqdm
+from src.utils import atomic_write
 
 
 
 
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
 logger = logging.getLogger(__name__)
 
+# Clause files at least this large are streamed with ijson (if installed)
+# instead of being parsed into memory whole
+_STREAMING_JSON_MIN_BYTES = 8_000_000
+_IJSON_ERRORS = (ijson.JSONError,) if ijson is not None else ()
+
+
+class QueryCache:
+    """
+    Thread-safe LRU cache with a per-entry TTL for collection query results.
+    Keys are combined with a generation counter, so bumping it via invalidate()
+    retires every cached result at once (e.g. after new clauses are upserted).
+    """
+
+    def __init__(self, max_size: int = 2000, ttl_seconds: float = 600):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.generation = 0
+        self._entries = OrderedDict()
+        self._lock = RLock()
+
+    def get(self, key: Hashable):
+        """Return the cached value for key, or None if it is missing or expired."""
+        full_key = (self.generation, key)
+        with self._lock:
+            entry = self._entries.get(full_key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[full_key]
+                return None
+            self._entries.move_to_end(full_key)
+            return value
+
+    def put(self, key: Hashable, value: Any):
+        """Store value under key, evicting the least recently used entries beyond max_size."""
+        with self._lock:
+            full_key = (self.generation, key)
+            self._entries[full_key] = (time.monotonic() + self.ttl_seconds, value)
+            self._entries.move_to_end(full_key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def get_or_compute(self, key: Hashable, compute: Callable[[], Any]):
+        """Return the cached value for key, calling compute() and caching its result on a miss."""
+        value = self.get(key)
+        if value is None:
+            value = compute()
+            self.put(key, value)
+        return value
+
+    def invalidate(self):
+        """Drop every cached entry by moving to a new generation."""
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+
+
+_query_cache = QueryCache()
+
+
+def configure_query_cache(max_size: int = 2000, ttl_seconds: float = 600) -> QueryCache:
+    """Replace the module-level query cache with one using the given limits and return it."""
+    global _query_cache
+    _query_cache = QueryCache(max_size=max_size, ttl_seconds=ttl_seconds)
+    return _query_cache
+
+def embedding_cache_key(embedding_function) -> str:
+    """
+    Return the name cached embeddings of embedding_function are stored under:
+    its cache_key attribute if it has one (embedding functions that take a model
+    parameter include the model there), else its class name.
+    """
+    return getattr(embedding_function, "cache_key", None) or type(embedding_function).__name__
+
+
+class EmbeddingCache:
+    """
+    On-disk SQLite cache of text embeddings keyed by the SHA-1 of the text and
+    the embedding function's embedding_cache_key, so unchanged clauses are not
+    re-embedded on later runs. Safe to share between threads.
+    """
+
+    # Stay under SQLite's host parameter limit in IN (...) lookups
+    _LOOKUP_BATCH = 500
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self._lock = RLock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                "model TEXT NOT NULL, hash TEXT NOT NULL, vector BLOB NOT NULL, "
+                "PRIMARY KEY (model, hash)) WITHOUT ROWID"
+            )
+
+    def embed(self, texts: List[str], embedding_function) -> List[np.ndarray]:
+        """Return embeddings for texts, computing and storing only the ones not cached yet."""
+        model = embedding_cache_key(embedding_function)
+        hashes = [hashlib.sha1(text.encode("utf-8")).hexdigest() for text in texts]
+        found = self._get_many(model, hashes)
+
+        misses = [i for i, h in enumerate(hashes) if h not in found]
+        if misses:
+            computed = embedding_function([texts[i] for i in misses])
+            new_vectors = {hashes[i]: np.asarray(vector, dtype=np.float32) for i, vector in zip(misses, computed)}
+            self._put_many(model, new_vectors)
+            found.update(new_vectors)
+        return [found[h] for h in hashes]
+
+    def _get_many(self, model: str, hashes: List[str]) -> Dict[str, np.ndarray]:
+        found = {}
+        unique_hashes = list(dict.fromkeys(hashes))
+        with self._lock:
+            for i in range(0, len(unique_hashes), self._LOOKUP_BATCH):
+                batch = unique_hashes[i : i + self._LOOKUP_BATCH]
+                rows = self._conn.execute(
+                    f"SELECT hash, vector FROM embeddings WHERE model = ? AND hash IN ({','.join('?' * len(batch))})",
+                    [model, *batch]
+                )
+                for h, blob in rows:
+                    found[h] = np.frombuffer(blob, dtype=np.float32)
+        return found
+
+    def _put_many(self, model: str, vectors: Dict[str, np.ndarray]):
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, hash, vector) VALUES (?, ?, ?)",
+                [(model, h, vector.tobytes()) for h, vector in vectors.items()]
+            )
+
+
+class InfinityEmbeddingFunction(EmbeddingFunction[Documents]):
+    """
+    Embedding function backed by an Infinity server (https://github.com/michaelfeil/infinity),
+    which dynamically batches requests and can run the model on GPU.
+    Texts are sent to its OpenAI-compatible /embeddings endpoint in batches of batch_size.
+    """
+
+    def __init__(
+        self,
+        url: str = "http://localhost:7997",
+        model: str = "sentence-transformers/all-MiniLM-L6-v2",
+        batch_size: int = 128,
+        timeout: float = 60
+    ):
+        self.url = url.rstrip("/")
+        self.model = model
+        self.cache_key = f"{type(self).__name__}:{model}"
+        self.batch_size = batch_size
+        self.timeout = timeout
+
+    def is_available(self) -> bool:
+        """Return True if the Infinity server answers its health check."""
+        try:
+            return requests.get(f"{self.url}/health", timeout=2).ok
+        except requests.RequestException:
+            return False
+
+    def __call__(self, input: Documents) -> Embeddings:
+        embeddings = []
+        for i in range(0, len(input), self.batch_size):
+            response = requests.post(
+                f"{self.url}/embeddings",
+                json={"model": self.model, "input": list(input[i : i + self.batch_size])},
+                timeout=self.timeout
+            )
+            response.raise_for_status()
+            data = sorted(response.json()["data"], key=lambda item: item["index"])
+            embeddings.extend(np.asarray(item["embedding"], dtype=np.float32) for item in data)
+        return embeddings
+
+
+class SentenceTransformerEmbeddingFunction(EmbeddingFunction[Documents]):
+    """
+    Embedding function running a sentence-transformers model in-process, on GPU
+    when one is available (in FP16) and otherwise on CPU.
+    Embeddings are L2-normalized, like those of Chroma's default model.
+    """
+
+    def __init__(
+        self,
+        model_name: str = "all-MiniLM-L6-v2",
+        device: Optional[str] = None,
+        batch_size: int = 256
+    ):
+        import torch
+        from sentence_transformers import SentenceTransformer
+
+        if device is None:
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.device = device
+        self.batch_size = batch_size
+        self.cache_key = f"{type(self).__name__}:{model_name}"
+        self.model = SentenceTransformer(model_name, device=device)
+        if device.startswith("cuda"):
+            self.model.half()
+
+    def __call__(self, input: Documents) -> Embeddings:
+        embeddings = self.model.encode(
+            list(input),
+            batch_size=self.batch_size,
+            convert_to_numpy=True,
+            normalize_embeddings=True
+        )
+        return list(embeddings.astype(np.float32, copy=False))
+
+
+class QuantizedONNXMiniLM_L6_V2(ONNXMiniLM_L6_V2):
+    """
+    Chroma's default all-MiniLM-L6-v2 ONNX embedding function, run on an INT8
+    dynamically quantized copy of the model (made once with onnxruntime's
+    quantize_dynamic next to the downloaded model) using every CPU core.
+    Int8 weights halve memory traffic and use VNNI/AMX dot products where available.
+    """
+
+    QUANTIZED_MODEL_FILENAME = "model_int8.onnx"
+
+    def _quantized_model_path(self) -> str:
+        """Return the INT8 model path, quantizing the downloaded FP32 model on first use."""
+        model_dir = os.path.join(self.DOWNLOAD_PATH, self.EXTRACTED_FOLDER_NAME)
+        quantized_path = os.path.join(model_dir, self.QUANTIZED_MODEL_FILENAME)
+        if not os.path.exists(quantized_path):
+            from onnxruntime.quantization import QuantType, quantize_dynamic
+
+            logger.info(f"Quantizing {self.MODEL_NAME} to INT8 at {quantized_path}")
+            tmp_path = f"{quantized_path}.{os.getpid()}.tmp"
+            quantize_dynamic(os.path.join(model_dir, "model.onnx"), tmp_path, weight_type=QuantType.QInt8)
+            os.replace(tmp_path, quantized_path)
+        return quantized_path
+
+    @cached_property
+    def model(self):
+        so = self.ort.SessionOptions()
+        so.log_severity_level = 3
+        so.intra_op_num_threads = os.cpu_count() or 1
+        return self.ort.InferenceSession(
+            self._quantized_model_path(),
+            providers=["CPUExecutionProvider"],
+            sess_options=so,
+        )
+
+
+@lru_cache(maxsize=None)
+def get_embedding_function(
+    backend: str = "default",
+    infinity_url: str = "http://localhost:7997",
+    device: Optional[str] = None
+):
+    """
+    Return the embedding function shared by the collection and SOP embedding cache.
+    backend="infinity" uses an Infinity server at infinity_url, falling back to
+    Chroma's default embedding function when the server is unreachable.
+    backend="sentence-transformers" runs the model in-process on device (GPU if
+    available when None), falling back to the default if sentence-transformers
+    is not installed.
+    backend="onnx-int8" runs the default model quantized to INT8 on CPU, falling
+    back to the default if the onnx package (needed to quantize) is not installed.
+    """
+    if backend == "infinity":
+        ef = InfinityEmbeddingFunction(url=infinity_url)
+        if ef.is_available():
+            logger.info(f"Using Infinity embedding server at {infinity_url}")
+            return ef
+        logger.warning(f"Infinity server at {infinity_url} is unreachable; using default embedding function")
+    elif backend == "sentence-transformers":
+        try:
+            ef = SentenceTransformerEmbeddingFunction(device=device)
+        except ImportError:
+            logger.warning("sentence-transformers is not installed; using default embedding function")
+        else:
+            logger.info(f"Using sentence-transformers embedding model on {ef.device}")
+            return ef
+    elif backend == "onnx-int8":
+        if importlib.util.find_spec("onnx") is not None:
+            logger.info("Using INT8 quantized ONNX embedding model")
+            return QuantizedONNXMiniLM_L6_V2()
+        logger.warning("onnx is not installed, cannot quantize the model; using default embedding function")
+    return embedding_functions.DefaultEmbeddingFunction()
+
+# Per-connection SQLite settings trading crash durability for write speed.
+# journal_mode=OFF and locking_mode=EXCLUSIVE are deliberately left out: Chroma
+# relies on rollbacks, and keeps one connection per thread, which an exclusive
+# lock held by one of them would block.
+_FAST_INGEST_PRAGMAS = {
+    "journal_mode": "MEMORY",
+    "synchronous": "OFF",
+    "temp_store": "MEMORY",
+}
+
+
+def enable_fast_ingest(client) -> None:
+    """
+    Apply _FAST_INGEST_PRAGMAS to every connection of the client's SQLite store,
+    including the per-thread connections Chroma opens later, and restore each
+    connection's previous settings at interpreter exit. Calling it again for the
+    same store does nothing.
+    A crash during ingestion can corrupt the store while these are in effect.
+    """
+    from chromadb.db.impl.sqlite import SqliteDB
+
+    pool = client._system.instance(SqliteDB)._conn_pool
+    if getattr(pool, "_fast_ingest", False):
+        return
+    pool._fast_ingest = True
+    connect = pool.connect
+    tuned = []
+
+    def fast_connect(*args, **kwargs):
+        conn = connect(*args, **kwargs)
+        # PRAGMAs can't change the journal or sync mode inside a transaction
+        if not getattr(conn, "_fast_ingest", False) and not conn._conn.in_transaction:
+            previous = {}
+            for name, value in _FAST_INGEST_PRAGMAS.items():
+                previous[name] = conn.execute(f"PRAGMA {name}").fetchone()[0]
+                conn.execute(f"PRAGMA {name} = {value}")
+            conn._fast_ingest = True
+            tuned.append((conn, previous))
+        return conn
+
+    def restore():
+        for conn, previous in tuned:
+            try:
+                for name, value in previous.items():
+                    conn.execute(f"PRAGMA {name} = {value}")
+            except sqlite3.Error:
+                pass  # Connection already closed
+
+    pool.connect = fast_connect
+    atexit.register(restore)
+    logger.info("Fast ingest enabled: SQLite journaling and syncing relaxed")
+
+
+@lru_cache(maxsize=None)
+def _get_client(persist_directory: str):
+    """Return the PersistentClient for persist_directory, created once per process."""
+    return chromadb.PersistentClient(path=persist_directory)
+
+
+# Collections already opened, keyed by (persist_directory, collection_name, embedding function)
+_collection_cache = {}
+
+
 def initialize_chroma_collection(
         collection_name="regulatory-clauses", 
-        persist_directory="local_db"
+        persist_directory=None,
+        embedding_function=None,
+        fast_ingest=False
 ):
     """
-    Initialize a ChromaDB collection with an embedding function.
+    Initialize a persistent ChromaDB collection with an embedding function
+    (get_embedding_function() if none is given). The store lives in
+    persist_directory, defaulting to $CHROMA_PATH or "local_db".
+    If fast_ingest is set, the store's SQLite durability settings are relaxed
+    for faster bulk upserts (see enable_fast_ingest), also when the collection
+    was already opened without it.
+    The client and collection are memoized, so repeated calls in one process
+    return the same collection object.
     Returns the collection object.
     """
-    logger.info("Starting local ChromaDB Collection")
-    ef = embedding_functions.DefaultEmbeddingFunction()
-    client = chromadb.PersistentClient(path=persist_directory)
-
-    collection = client.get_or_create_collection(
-        name=collection_name,
-        embedding_function=ef
-    )
+    if persist_directory is None:
+        persist_directory = os.environ.get("CHROMA_PATH", "local_db")
+    ef = embedding_function if embedding_function is not None else get_embedding_function()
+    key = (persist_directory, collection_name, ef)
+    collection = _collection_cache.get(key)
+    if collection is None:
+        logger.info(f"Starting local ChromaDB Collection at {persist_directory}")
+        client = _get_client(persist_directory)
+        collection = client.get_or_create_collection(
+            name=collection_name,
+            embedding_function=ef
+        )
+        _collection_cache[key] = collection
+    if fast_ingest:
+        enable_fast_ingest(_get_client(persist_directory))
     return collection
 
-def flatten_clauses(clause_obj):
+def new_clause_columns() -> Dict[str, List[str]]:
+    """
+    Return an empty column layout for flattened clauses: parallel lists
+    'doc_ids', 'ids' and 'texts', with one entry per clause at the same index.
+    """
+    return {"doc_ids": [], "ids": [], "texts": []}
+
+
+def flatten_into(clause_obj, columns: Dict[str, List[str]], doc_id: str):
     """
-    Recursively flattens a clause that may contain nested 'subclauses'.
-    Returns a list of {'id': str, 'text': str}.
+    Flattens a clause that may contain nested 'subclauses', in depth-first
+    order (each clause followed by its subclauses), using an explicit stack.
+    Appends each clause's doc_id, id and text to the columns
+    (see new_clause_columns).
     """
-    flattened = [{
-        "id": clause_obj["id"],
-        "text": clause_obj["text"]
-    }]
+    doc_ids, ids, texts = columns["doc_ids"], columns["ids"], columns["texts"]
+    stack = [clause_obj]
+    while stack:
+        clause = stack.pop()
+        doc_ids.append(doc_id)
+        ids.append(clause["id"])
+        texts.append(clause["text"])
+        subclauses = clause.get("subclauses")
+        if subclauses:
+            # Reversed, so the first subclause is popped next
+            stack.extend(reversed(subclauses))
 
-    # If there are subclauses, recurse
-    if "subclauses" in clause_obj and clause_obj["subclauses"]:
-        for sub in clause_obj["subclauses"]:
-            flattened.extend(flatten_clauses(sub))
 
-    return flattened
+def _iter_clause_objects(f, size: int):
+    """
+    Yield the top-level clause objects of an opened clauses JSON file of the
+    given size. Files of _STREAMING_JSON_MIN_BYTES or more are streamed with
+    ijson when it is installed; others are parsed whole from a memory map.
+    Raises ValueError if the file is not a JSON list.
+    """
+    if ijson is not None and size >= _STREAMING_JSON_MIN_BYTES:
+        # ijson silently yields nothing for a non-list, so check the opening bracket
+        head = f.read(64).lstrip()
+        if not head.startswith(b"["):
+            raise ValueError("not a JSON list")
+        f.seek(0)
+        yield from ijson.items(f, "item")
+        return
 
+    # Parse straight out of a read-only mapping of the file (mmap rejects empty files)
+    if size:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as buf:
+            data = orjson.loads(buf)
+    else:
+        data = orjson.loads(b"")
+    if not isinstance(data, list):
+        raise ValueError("not a JSON list")
+    yield from data
 
-def load_clauses(clauses_dir: str) -> List[Dict]:
+
+def _parse_file(filepath: str) -> Dict[str, List[str]]:
     """
-    Load all extracted clauses from JSON files in a directory.
-    Each file's name is used to derive doc_id (stripping last 8 chars if present).
-    Returns a list of {'doc_id':..., 'id':..., 'text':...}.
+    Parse one clauses JSON file and return its flattened clauses as columns
+    (see new_clause_columns), labelled with the doc_id derived from the file
+    name. Unusable files are logged and yield empty columns.
     """
-    all_clauses = []
-    for filename in os.listdir(clauses_dir):
-        if filename.lower().endswith(".json"):
-            filepath = os.path.join(clauses_dir, filename)
-            doc_id, _ = os.path.splitext(filename)
+    filename = os.path.basename(filepath)
+    doc_id = filename[:-5]  # only *.json files are passed in
+    if doc_id.endswith("_clauses"):
+        doc_id = doc_id[:-8]  # remove last 8 chars
+    # One shared doc_id string per file for all of its clauses
+    doc_id = sys.intern(doc_id)
 
-            if doc_id.endswith("_clauses"):
-                doc_id = doc_id[:-8]  # remove last 8 chars
+    columns = new_clause_columns()
+    with open(filepath, "rb") as f:
+        try:
+            for clause_obj in _iter_clause_objects(f, os.fstat(f.fileno()).st_size):
+                flatten_into(clause_obj, columns, doc_id)
+        except (orjson.JSONDecodeError, *_IJSON_ERRORS):
+            logger.error(f"Error decoding JSON in file: {filename}")
+            return new_clause_columns()
+        except ValueError:
+            logger.warning(f"File {filename} did not contain a list. Skipping.")
+            return new_clause_columns()
+    return columns
 
-            with open(filepath, "r", encoding="utf-8") as f:
-                try:
-                    data = json.load(f)
-                except json.JSONDecodeError:
-                    logger.error(f"Error decoding JSON in file: {filename}")
-                    continue
 
-                if not isinstance(data, list):
-                    logger.warning(f"File {filename} did not contain a list. Skipping.")
-                    continue
+def _clause_file_paths(clauses_dir: str) -> List[str]:
+    with os.scandir(clauses_dir) as it:
+        return [e.path for e in it if e.is_file() and e.name.lower().endswith(".json")]
 
-                for clause_obj in data:
-                    flattened = flatten_clauses(clause_obj)
-                    for item in flattened:
-                        item["doc_id"] = doc_id
-                        all_clauses.append(item)
-    return all_clauses
 
+def _iter_parsed_files(filepaths: List[str], max_workers: Optional[int] = None):
+    """
+    Yield _parse_file's columns for each of filepaths, in order, parsing them in a
+    process pool with at most 2 * max_workers files parsed ahead of the consumer.
+    """
+    if max_workers is None:
+        max_workers = min(os.cpu_count() or 1, len(filepaths))
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque()
+        for filepath in filepaths:
+            if len(pending) >= 2 * max_workers:
+                yield pending.popleft().result()
+            pending.append(executor.submit(_parse_file, filepath))
+        while pending:
+            yield pending.popleft().result()
 
-def assign_unique_ids(clauses: List[Dict]) -> List[Dict]:
+
+_BATCH_COLUMNS = ("stable_ids", "doc_ids", "ids", "texts")
+
+
+def _produce_clause_batches(
+    filepaths: List[str],
+    chunk_size: int,
+    batches: queue.Queue,
+    stop: Event
+):
+    """
+    Producer for add_clauses_to_vectordb: parse filepaths, assign their stable IDs
+    (see assign_unique_ids) and put clause column batches of chunk_size on batches,
+    followed by None at the end or the exception that stopped parsing.
+    The last full batch is held back until the end, so that a small remainder is
+    evened out with it instead of being upserted as a batch of its own.
+    Returns early once stop is set.
+    """
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    try:
+        # Shared across files, as two files can map to the same doc_id
+        seen = {}
+        batch = {name: [] for name in _BATCH_COLUMNS}
+        held = None
+        for columns in _iter_parsed_files(filepaths):
+            assign_unique_ids(columns, seen)
+            start, n_clauses = 0, len(columns["ids"])
+            while start < n_clauses:
+                end = min(start + chunk_size - len(batch["ids"]), n_clauses)
+                for name in _BATCH_COLUMNS:
+                    batch[name].extend(columns[name][start:end])
+                start = end
+                if len(batch["ids"]) == chunk_size:
+                    if held is not None and not put(held):
+                        return
+                    held = batch
+                    batch = {name: [] for name in _BATCH_COLUMNS}
+
+        if held is not None and batch["ids"]:
+            # Split the held batch and the remainder into two even batches
+            tail = {name: held[name] + batch[name] for name in _BATCH_COLUMNS}
+            half = math.ceil(len(tail["ids"]) / 2)
+            held = {name: values[:half] for name, values in tail.items()}
+            batch = {name: values[half:] for name, values in tail.items()}
+        for last in (held, batch):
+            if last is not None and last["ids"] and not put(last):
+                return
+        put(None)
+    except BaseException as e:
+        put(e)
+
+
+def assign_unique_ids(clauses: Dict[str, List[str]], seen: Optional[Dict[str, int]] = None) -> Dict[str, List[str]]:
     """
     For each clause, combine doc_id + id into a base_id, then if repeated,
     append a numeric suffix: e.g., 'DOC-1.1-2' for a 2nd occurrence in the same dataset.
-    Updates clauses in place, returns the same list.
-    """
-    id_counter = defaultdict(int)
-    for clause in clauses:
-        base_id = f"{clause['doc_id']}-{clause['id']}"
-        id_counter[base_id] += 1
-        # If first occurrence, stable_id = base_id
-        if id_counter[base_id] == 1:
-            clause["stable_id"] = base_id
-        else:
-            # Append suffix for repeated base_id
-            clause["stable_id"] = f"{base_id}-{id_counter[base_id]}"
+    seen maps each base_id to its occurrences so far; pass the same dict for every
+    part of a dataset to number repeats across the parts.
+    Adds a 'stable_ids' column to the clause columns in place, returns the same dict.
+    """
+    if seen is None:
+        seen = {}
+    base_ids = [f"{doc_id}-{clause_id}" for doc_id, clause_id in zip(clauses["doc_ids"], clauses["ids"])]
+    unique = dict.fromkeys(base_ids, 1)
+    if len(unique) == len(base_ids) and seen.keys().isdisjoint(unique):
+        # No repeats (the common case), stable_id = base_id
+        seen.update(unique)
+        clauses["stable_ids"] = base_ids
+        return clauses
+
+    counts = Counter(base_ids)
+    # base_ids repeated within these clauses or already seen in an earlier part
+    duplicates = {base_id for base_id, count in counts.items() if count > 1 or base_id in seen}
+    occurrences = {base_id: seen.get(base_id, 0) for base_id in duplicates}
+    seen.update(counts)
+    for base_id in duplicates:
+        seen[base_id] = occurrences[base_id] + counts[base_id]
+
+    stable_ids = []
+    for base_id in base_ids:
+        if base_id not in duplicates:
+            # Unique base_id (the common case), stable_id = base_id
+            stable_ids.append(base_id)
+            continue
+        occurrence = occurrences[base_id] + 1
+        occurrences[base_id] = occurrence
+        # First occurrence keeps base_id, repeats get a suffix
+        stable_ids.append(base_id if occurrence == 1 else f"{base_id}-{occurrence}")
+    clauses["stable_ids"] = stable_ids
     return clauses
 
 
-def chunked_upsert(collection: object, data: List[Dict], chunk_size: int = 1000):
+def default_upsert_chunk_size(collection) -> int:
     """
-    Upsert data into Chroma in batches, showing progress via tqdm.
-    Each item in 'data' should have 'stable_id', 'text', and 'doc_id', 'id'.
+    Return the upsert batch size for collection: 250 when it is reached over
+    HTTP (larger batches hurt tail latency there), else 500 for a local store.
     """
-    total = len(data)
-    if total == 0:
-        logger.warning("No data to upsert.")
-        return
+    from chromadb.api.fastapi import FastAPI
+
+    return 250 if isinstance(collection._client, FastAPI) else 500
 
-    logger.info(f"Starting upsert of {total} items in chunks of {chunk_size}.")
-    with tqdm(total=total, desc="Upserting clauses", unit="clause") as pbar:
-        for i in range(0, total, chunk_size):
-            batch = data[i : i + chunk_size]
-            documents = [item["text"] for item in batch]
-            metadatas = [{"doc_id": item["doc_id"], "clause_id": item["id"]} for item in batch]
-            ids = [item["stable_id"] for item in batch]
 
+def upsert_batches(
+    collection: object,
+    batches,
+    embedding_function: Optional[Callable[[Documents], Embeddings]] = None,
+    max_workers: Optional[int] = None,
+    embedding_cache: Optional[EmbeddingCache] = None
+) -> int:
+    """
+    Upsert an iterable of clause column batches into Chroma, showing progress via
+    tqdm. Each batch holds the columns 'stable_ids',
+    'texts', 'doc_ids' and 'ids' (see assign_unique_ids); metadata dicts are only
+    built per batch. Returns the number of clauses upserted.
+    Batches are embedded and upserted on a pool of max_workers threads (embedding
+    inference releases the GIL), with at most 2 * max_workers batches in flight,
+    so batches are only pulled from the iterable as the pool frees up. The first
+    failed batch stops further batches from being pulled and its error is raised.
+    If embedding_function is given, each batch is embedded with it and upserted
+    with the embeddings; otherwise the collection embeds each batch.
+    If embedding_cache is given, texts it already holds embeddings for are not
+    re-embedded (the collection's embedding function is used if none is given).
+    """
+    if max_workers is None:
+        max_workers = min(8, os.cpu_count() or 1)
+    if embedding_cache is not None and embedding_function is None:
+        embedding_function = collection._embedding_function
+
+    def upsert_batch(batch: Dict[str, List[str]]) -> int:
+        documents = batch["texts"]
+        metadatas = [
+            {"doc_id": doc_id, "clause_id": clause_id}
+            for doc_id, clause_id in zip(batch["doc_ids"], batch["ids"])
+        ]
+        ids = batch["stable_ids"]
+
+        if embedding_function is not None:
+            if embedding_cache is not None:
+                embeddings = embedding_cache.embed(documents, embedding_function)
+            else:
+                embeddings = embedding_function(documents)
+            collection.upsert(
+                documents=documents,
+                embeddings=embeddings,
+                metadatas=metadatas,
+                ids=ids
+            )
+        else:
             collection.upsert(documents=documents, metadatas=metadatas, ids=ids)
-            pbar.update(len(batch))
+        return len(ids)
+
+    batches = iter(batches)
+    first_batch = next(batches, None)
+    if first_batch is None:
+        return 0
+
+    in_flight = BoundedSemaphore(2 * max_workers)
+    # Set by the first failed batch, so no further batches are pulled or submitted
+    failed = Event()
+    errors = []
+    futures = []
+    with tqdm(desc="Upserting clauses", unit="clause") as pbar, \
+            ThreadPoolExecutor(max_workers=max_workers) as executor:
+
+        def on_done(future):
+            in_flight.release()
+            if future.cancelled():
+                return
+            error = future.exception()
+            if error is None:
+                # Progress counts completed batches, not submitted ones
+                pbar.update(future.result())
+            elif not failed.is_set():
+                errors.append(error)
+                failed.set()
+
+        # Run the first batch alone so lazy model loading (and Chroma's one-time
+        # model download) happens once, before batches run concurrently
+        upserted = upsert_batch(first_batch)
+        pbar.update(upserted)
+        for batch in batches:
+            in_flight.acquire()
+            if failed.is_set():
+                in_flight.release()
+                break
+            future = executor.submit(upsert_batch, batch)
+            future.add_done_callback(on_done)
+            futures.append(future)
+        if failed.is_set():
+            # Drop queued batches; the with block still waits for running ones
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    if errors:
+        raise errors[0]
+    upserted += sum(future.result() for future in futures)
 
     logger.info(f"Completed upsert. Collection count is now {collection.count()}.")
+    return upserted
 
 
-def add_clauses_to_vectordb(collection: object, clauses_dir: str, chunk_size: int = 1000):
+def add_clauses_to_vectordb(
+    collection: object,
+    clauses_dir: str,
+    chunk_size: Optional[int] = None,
+    embedding_function: Optional[Callable[[Documents], Embeddings]] = None,
+    embedding_cache_path: Optional[str] = None
+):
     """
     Main entry: loads clauses from a directory, assigns unique stable IDs,
     then upserts them to the collection in batches.
+    chunk_size defaults to default_upsert_chunk_size(collection) and is an upper
+    bound: the last two batches are evened out so the last one is not a small
+    remainder.
+    Loading and upserting are pipelined: a producer thread parses the files and
+    queues ready batches (see _produce_clause_batches) while they are upserted,
+    so only a few batches of clauses are held in memory at a time.
+    See upsert_batches for embedding_function. If embedding_cache_path is given,
+    clause embeddings are cached there (see EmbeddingCache) across runs.
     """
-    logger.info("Loading extracted clauses...")
-    clauses = load_clauses(clauses_dir)
-    logger.info(f"Loaded {len(clauses)} clauses from {clauses_dir}.")
-
-    if not clauses:
+    filepaths = _clause_file_paths(clauses_dir)
+    if not filepaths:
         logger.warning("No clauses found. Exiting.")
         return
 
-    logger.info("Assigning unique IDs (doc_id + clause_id + optional suffix).")
-    clauses = assign_unique_ids(clauses)
+    if chunk_size is None:
+        chunk_size = default_upsert_chunk_size(collection)
+        logger.info(f"Using default upsert batch size {chunk_size}.")
+    logger.info(f"Beginning pipelined load and upsert of clauses from {len(filepaths)} files in chunks of {chunk_size}.")
 
-    logger.info(f"Beginning chunked upsert with batch size={chunk_size}.")
-    chunked_upsert(collection, clauses, chunk_size)
+    batches = queue.Queue(maxsize=4)
+    stop = Event()
+    producer = Thread(
+        target=_produce_clause_batches,
+        args=(filepaths, chunk_size, batches, stop),
+        name="clause-loader",
+        daemon=True
+    )
+
+    def iter_batches():
+        while True:
+            item = batches.get()
+            if item is None:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+
+    embedding_cache = EmbeddingCache(embedding_cache_path) if embedding_cache_path else None
+    producer.start()
+    try:
+        upserted = upsert_batches(
+            collection,
+            iter_batches(),
+            embedding_function=embedding_function,
+            embedding_cache=embedding_cache
+        )
+    finally:
+        stop.set()
+        producer.join()
+    _query_cache.invalidate()
+
+    if upserted == 0:
+        logger.warning("No clauses found. Exiting.")
+    else:
+        logger.info(f"Upserted {upserted} clauses from {clauses_dir}.")
+
+
+def load_or_compute_sop_embeddings(
+    sop_path: str,
+    embedding_function,
+    cache_dir: str,
+    chunk_size: int = 200,
+    overlap: int = 50
+) -> np.ndarray:
+    """
+    Return the embeddings of the SOP's chunks, one row per chunk_text() chunk.
+    Results are cached as .npy files in cache_dir, keyed on the SOP content,
+    chunking parameters and embedding_cache_key(embedding_function), so unchanged
+    SOPs are not re-embedded.
+    """
+    with open(sop_path, "rb") as f:
+        sop_bytes = f.read()
+    digest = hashlib.sha256(sop_bytes).hexdigest()
+    # Model names can contain path separators
+    model_key = "".join(
+        c if c.isalnum() or c in "-_." else "_" for c in embedding_cache_key(embedding_function)
+    )
+    cache_name = f"{digest}_{chunk_size}_{overlap}_{model_key}.npy"
+    cache_path = os.path.join(cache_dir, cache_name)
+
+    if os.path.exists(cache_path):
+        logger.info(f"Loading cached SOP embeddings from {cache_path}")
+        return np.load(cache_path)
+
+    logger.info("Computing SOP embeddings...")
+    chunks = chunk_text(sop_bytes.decode("utf-8"), chunk_size=chunk_size, overlap=overlap)
+    embeddings = np.asarray(embedding_function(chunks) if chunks else [], dtype=np.float32)
+    os.makedirs(cache_dir, exist_ok=True)
+    # Written atomically, as a truncated .npy would fail every later np.load
+    with atomic_write(cache_path, "wb") as f:
+        np.save(f, embeddings)
+    return embeddings
 
 
 def retrieve_relevant_clauses_for_sop(
@@ -151,12 +835,15 @@ def retrieve_relevant_clauses_for_sop(
     collection,
     chunk_size: int = 200,
     overlap: int = 50,
-    top_n: int = 3
+    top_n: int = 3,
+    precomputed_embeddings: Optional[np.ndarray] = None
 ):
     """
     1) Read the SOP text file.
     2) Split it into chunks.
-    3) For each chunk, query the Chroma collection to get top_n relevant clauses.
+    3) Query the Chroma collection once for all uncached chunks to get top_n relevant clauses each.
+       If precomputed_embeddings (one row per chunk, see load_or_compute_sop_embeddings)
+       is given, it is queried directly instead of re-embedding the chunks.
     4) Return a list of dicts like:
        [
          {
@@ -170,26 +857,86 @@ def retrieve_relevant_clauses_for_sop(
        ]
     """
     logger.info("Start retrieving relevant clauses...")
+    chunks, cache_keys, chunk_clauses_list, misses = _prepare_sop_retrieval(
+        sop_path, collection, chunk_size, overlap, top_n, precomputed_embeddings
+    )
+    if misses:
+        missed_clauses = batched_query(
+            collection,
+            **_miss_queries(chunks, misses, precomputed_embeddings),
+            n_results=top_n
+        )
+        _fill_misses(cache_keys, chunk_clauses_list, misses, missed_clauses)
+    return _format_sop_results(chunks, chunk_clauses_list)
+
+
+async def aretrieve_relevant_clauses_for_sop(
+    sop_path: str,
+    collection,
+    chunk_size: int = 200,
+    overlap: int = 50,
+    top_n: int = 3,
+    precomputed_embeddings: Optional[np.ndarray] = None
+):
+    """
+    Async counterpart of retrieve_relevant_clauses_for_sop with the same arguments
+    and result. The query batches for uncached chunks run concurrently (see
+    abatched_query), so collection may also be an AsyncCollection from
+    chromadb.AsyncHttpClient.
+    """
+    logger.info("Start retrieving relevant clauses...")
+    chunks, cache_keys, chunk_clauses_list, misses = _prepare_sop_retrieval(
+        sop_path, collection, chunk_size, overlap, top_n, precomputed_embeddings
+    )
+    if misses:
+        missed_clauses = await abatched_query(
+            collection,
+            **_miss_queries(chunks, misses, precomputed_embeddings),
+            n_results=top_n
+        )
+        _fill_misses(cache_keys, chunk_clauses_list, misses, missed_clauses)
+    return _format_sop_results(chunks, chunk_clauses_list)
+
+
+def _prepare_sop_retrieval(sop_path, collection, chunk_size, overlap, top_n, precomputed_embeddings):
+    """
+    Chunk the SOP and look every chunk up in the query cache.
+    Returns (chunks, cache_keys, cached clause lists with None for misses, miss indexes).
+    """
     with open(sop_path, "r", encoding="utf-8") as f:
         sop_text = f.read()
     chunks = chunk_text(sop_text, chunk_size=chunk_size, overlap=overlap)
-
-    results = []
-    for chunk in chunks:
-        query_res = collection.query(
-            query_texts=[chunk],
-            n_results=top_n
+    if precomputed_embeddings is not None and len(precomputed_embeddings) != len(chunks):
+        raise ValueError(
+            f"Got {len(precomputed_embeddings)} precomputed embeddings for {len(chunks)} SOP chunks"
         )
-        chunk_clauses = []
-        if query_res and query_res.get("ids") and len(query_res["ids"]) > 0:
-            for i, doc_id in enumerate(query_res["ids"][0]):
-                chunk_clauses.append({
-                    "id": doc_id,
-                    "text": query_res["documents"][0][i],
-                    "metadata": query_res["metadatas"][0][i],
-                    "distance": query_res["distances"][0][i]
-                })
 
+    cache_keys = [
+        (collection.name, hashlib.sha256(chunk.encode("utf-8")).hexdigest(), top_n)
+        for chunk in chunks
+    ]
+    chunk_clauses_list = [_query_cache.get(key) for key in cache_keys]
+    misses = [i for i, chunk_clauses in enumerate(chunk_clauses_list) if chunk_clauses is None]
+    return chunks, cache_keys, chunk_clauses_list, misses
+
+
+def _miss_queries(chunks, misses, precomputed_embeddings) -> Dict[str, List]:
+    """Return the batched_query keyword arguments querying the missed chunks."""
+    if precomputed_embeddings is not None:
+        return {"query_embeddings": [precomputed_embeddings[i] for i in misses]}
+    return {"query_texts": [chunks[i] for i in misses]}
+
+
+def _fill_misses(cache_keys, chunk_clauses_list, misses, missed_clauses):
+    """Cache the clauses retrieved for missed chunks and slot them into chunk_clauses_list."""
+    for ci, chunk_clauses in zip(misses, missed_clauses):
+        _query_cache.put(cache_keys[ci], chunk_clauses)
+        chunk_clauses_list[ci] = chunk_clauses
+
+
+def _format_sop_results(chunks, chunk_clauses_list) -> List[Dict]:
+    results = []
+    for chunk, chunk_clauses in zip(chunks, chunk_clauses_list):
         results.append({
             "chunk_text": chunk,
             "relevant_clauses": chunk_clauses
@@ -198,6 +945,72 @@ def retrieve_relevant_clauses_for_sop(
     return results
 
 
+def batched_query(
+    collection,
+    query_texts: Optional[List[str]] = None,
+    query_embeddings: Optional[List] = None,
+    n_results: int = 3,
+    batch_size: int = 64
+) -> List[List[Dict]]:
+    """
+    Query the collection with query_texts or query_embeddings, batch_size queries
+    per collection.query call, so embedding and HNSW search setup are shared by a
+    batch without sending every query in one request.
+    Returns one list of clause dicts (see _clauses_from_query_result) per query.
+    """
+    queries = query_embeddings if query_embeddings is not None else query_texts
+    query_key = "query_embeddings" if query_embeddings is not None else "query_texts"
+    results = []
+    for i in range(0, len(queries), batch_size):
+        batch = queries[i : i + batch_size]
+        query_res = collection.query(**{query_key: batch}, n_results=n_results)
+        results.extend(_clauses_from_query_result(query_res, qi) for qi in range(len(batch)))
+    return results
+
+
+async def abatched_query(
+    collection,
+    query_texts: Optional[List[str]] = None,
+    query_embeddings: Optional[List] = None,
+    n_results: int = 3,
+    batch_size: int = 64
+) -> List[List[Dict]]:
+    """
+    Async counterpart of batched_query that runs all batches concurrently.
+    An AsyncCollection's query is awaited directly; a regular collection's
+    blocking query runs in a worker thread per batch.
+    """
+    queries = query_embeddings if query_embeddings is not None else query_texts
+    query_key = "query_embeddings" if query_embeddings is not None else "query_texts"
+
+    async def query_batch(batch):
+        if inspect.iscoroutinefunction(collection.query):
+            return await collection.query(**{query_key: batch}, n_results=n_results)
+        return await asyncio.to_thread(collection.query, **{query_key: batch}, n_results=n_results)
+
+    batches = [queries[i : i + batch_size] for i in range(0, len(queries), batch_size)]
+    query_results = await asyncio.gather(*(query_batch(batch) for batch in batches))
+
+    results = []
+    for batch, query_res in zip(batches, query_results):
+        results.extend(_clauses_from_query_result(query_res, qi) for qi in range(len(batch)))
+    return results
+
+
+def _clauses_from_query_result(query_res, qi: int) -> List[Dict]:
+    """Unpack the qi-th query of a batched collection.query result into clause dicts."""
+    chunk_clauses = []
+    if query_res and query_res.get("ids") and len(query_res["ids"]) > qi:
+        for i, doc_id in enumerate(query_res["ids"][qi]):
+            chunk_clauses.append({
+                "id": doc_id,
+                "text": query_res["documents"][qi][i],
+                "metadata": query_res["metadatas"][qi][i],
+                "distance": query_res["distances"][qi][i]
+            })
+    return chunk_clauses
+
+
 def chunk_text(text: str, chunk_size: int = 100, overlap: int = 25):
     """
     Splits text into chunks of roughly 'chunk_size' words
@@ -206,18 +1019,6 @@ def chunk_text(text: str, chunk_size: int = 100, overlap: int = 25):
     and the next chunk starts 150 words after the previous.
     """
     words = text.split()
-    total_words = len(words)
-    chunks = []
-    start = 0
-
-    while start < total_words:
-        end = start + chunk_size
-        chunk_words = words[start:end]
-        # Build the chunk string
-        chunk_str = " ".join(chunk_words)
-        chunks.append(chunk_str)
-
-        # Move start forward by chunk_size - overlap
-        start += (chunk_size - overlap)
-
-    return chunks
\ No newline at end of file
+    # Each chunk starts chunk_size - overlap words after the previous one
+    stride = chunk_size - overlap
+    return [" ".join(words[start : start + chunk_size]) for start in range(0, len(words), stride)]
\ No newline at end of file